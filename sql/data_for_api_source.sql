@@ -0,0 +1,31 @@
+-- Pre-joined source rows for the data_for_api rebuild. The prices /
+-- smartphones / retailers join used to be re-assembled in Python from
+-- three separate queries; this view lets Postgres's join executor produce
+-- the final row shape, so the scripts fetch exactly the columns they
+-- insert and nothing else.
+--
+-- Column order matches DATA_FOR_API_COLUMNS in update_api_data.py.
+
+CREATE OR REPLACE VIEW data_for_api_source AS
+SELECT
+    p.price_id,
+    p.run_id,
+    p.smartphone_id,
+    p.retailer_id,
+    r.retailer_name,
+    p.price,
+    p.product_url,
+    COALESCE(p.is_hot, false) AS is_hot,
+    COALESCE(ROUND(p.hotness_score)::integer, 0) AS hotness_score,
+    s.oem,
+    s.model,
+    s.color_variant,
+    s.ram_variant,
+    s.rom_variant,
+    s.variant_rank,
+    s.os
+FROM prices p
+JOIN smartphones s USING (smartphone_id)
+JOIN retailers r USING (retailer_id)
+WHERE p.price_error = false
+  AND p.price IS NOT NULL;
@@ -0,0 +1,30 @@
+-- Delete data_for_api rows from previous runs in small chunks so each
+-- transaction stays short and never blocks concurrent inserts behind a
+-- long-running full-table DELETE.
+--
+-- Called from update_api_data.py via:
+--   supabase.rpc('delete_old_data_for_api', {'keep_run_id': run_id})
+
+CREATE OR REPLACE FUNCTION delete_old_data_for_api(keep_run_id uuid, chunk integer DEFAULT 50000)
+RETURNS integer
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+    deleted integer := 0;
+    batch integer;
+BEGIN
+    LOOP
+        DELETE FROM data_for_api
+        WHERE price_id IN (
+            SELECT price_id FROM data_for_api
+            WHERE run_id <> keep_run_id
+            LIMIT chunk
+        );
+        GET DIAGNOSTICS batch = ROW_COUNT;
+        deleted := deleted + batch;
+        EXIT WHEN batch < chunk;
+    END LOOP;
+    RETURN deleted;
+END;
+$$;
@@ -0,0 +1,62 @@
+-- Upsert a whole page of data_for_api rows inside a single transaction,
+-- so one commit (and one WAL fsync) covers what used to be one insert
+-- transaction per batch.
+--
+-- Rows arrive as a JSONB array of positional arrays in the order declared
+-- by DATA_FOR_API_COLUMNS in update_api_data.py, so the payload does not
+-- repeat the column names for every row.
+--
+-- Called from update_api_data.py via:
+--   supabase.rpc('insert_data_for_api_bulk', {'rows': rows})
+
+CREATE OR REPLACE FUNCTION insert_data_for_api_bulk(rows jsonb)
+RETURNS integer
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+    inserted integer;
+BEGIN
+    INSERT INTO data_for_api (
+        price_id, run_id, smartphone_id, retailer_id, retailer_name,
+        price, product_url, is_hot, hotness_score, oem, model,
+        color_variant, ram_variant, rom_variant, variant_rank, os
+    )
+    SELECT
+        (e->>0)::bigint,    -- price_id
+        (e->>1)::uuid,      -- run_id
+        (e->>2)::integer,   -- smartphone_id
+        (e->>3)::integer,   -- retailer_id
+        e->>4,              -- retailer_name
+        (e->>5)::numeric,   -- price
+        e->>6,              -- product_url
+        (e->>7)::boolean,   -- is_hot
+        (e->>8)::integer,   -- hotness_score
+        e->>9,              -- oem
+        e->>10,             -- model
+        e->>11,             -- color_variant
+        e->>12,             -- ram_variant
+        e->>13,             -- rom_variant
+        (e->>14)::integer,  -- variant_rank
+        e->>15              -- os
+    FROM jsonb_array_elements(rows) AS e
+    ON CONFLICT (price_id) DO UPDATE SET
+        run_id = EXCLUDED.run_id,
+        smartphone_id = EXCLUDED.smartphone_id,
+        retailer_id = EXCLUDED.retailer_id,
+        retailer_name = EXCLUDED.retailer_name,
+        price = EXCLUDED.price,
+        product_url = EXCLUDED.product_url,
+        is_hot = EXCLUDED.is_hot,
+        hotness_score = EXCLUDED.hotness_score,
+        oem = EXCLUDED.oem,
+        model = EXCLUDED.model,
+        color_variant = EXCLUDED.color_variant,
+        ram_variant = EXCLUDED.ram_variant,
+        rom_variant = EXCLUDED.rom_variant,
+        variant_rank = EXCLUDED.variant_rank,
+        os = EXCLUDED.os;
+    GET DIAGNOSTICS inserted = ROW_COUNT;
+    RETURN inserted;
+END;
+$$;
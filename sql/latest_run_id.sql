@@ -0,0 +1,18 @@
+-- Resolve the most recent run without sorting the prices table. run_id is
+-- a uuid, so max(run_id) would pick an arbitrary run; instead the run is
+-- keyed on max(date_recorded), which Postgres answers from the tail of the
+-- date_recorded index rather than an O(N log N) sort.
+--
+-- Called from update_hot_prices.py via:
+--   supabase.rpc('latest_run_id')
+
+CREATE OR REPLACE FUNCTION latest_run_id()
+RETURNS uuid
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT run_id
+    FROM prices
+    WHERE date_recorded = (SELECT max(date_recorded) FROM prices)
+    LIMIT 1;
+$$;
@@ -0,0 +1,19 @@
+-- Partial indexes for the hot-price recomputation path in
+-- update_hot_prices.py.
+--
+-- The paged SELECT filters on run_id and NOT price_error and reads only
+-- price_id/smartphone_id/retailer_id/price; the covering partial index
+-- below lets Postgres answer it with an index-only scan and keeps
+-- price_error=true rows out of the index entirely.
+--
+-- The second index narrows the daily reset UPDATE, which only ever needs
+-- to clear rows that are currently flagged hot.
+
+CREATE INDEX IF NOT EXISTS idx_prices_run_hot_path
+    ON prices (run_id, smartphone_id)
+    INCLUDE (retailer_id, price, price_id)
+    WHERE NOT price_error;
+
+CREATE INDEX IF NOT EXISTS idx_prices_hot_by_date
+    ON prices (date_recorded)
+    WHERE is_hot;
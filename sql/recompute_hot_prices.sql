@@ -0,0 +1,84 @@
+-- Recompute hot-price flags for the latest run entirely server-side,
+-- replacing the reset UPDATE, run_id lookup, full-run SELECT and N row
+-- UPDATEs that update_hot_prices.py performs with a single round trip.
+--
+-- Mirrors the Python criteria: top-5 lowest prices per smartphone from
+-- VERIFIED/ACTIVE retailers, at least 5 prices, 2 unique retailers and 1
+-- VERIFIED retailer in the top 5, and a price more than 15% below the
+-- top-5 average.
+--
+-- The whole body executes inside the single transaction PostgREST opens
+-- for the RPC, so reset and recompute are atomic: concurrent writers can
+-- never observe cleared flags without the fresh ones. The per-smartphone
+-- aggregates are materialized once into ON COMMIT DROP temp tables so the
+-- candidate scan runs a single time, and synchronous_commit is relaxed
+-- for this transaction only — the flags are recomputed daily and losing
+-- the very last commit in a crash just means one re-run.
+--
+-- Called from update_hot_prices.py via:
+--   supabase.rpc('recompute_hot_prices')
+
+CREATE OR REPLACE FUNCTION recompute_hot_prices()
+RETURNS integer
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+    updated integer;
+    v_run_id uuid;
+BEGIN
+    SET LOCAL synchronous_commit = off;
+
+    -- Reset today's flags before recomputing. Only currently-hot rows need
+    -- clearing (a score is never set without the flag), and the is_hot
+    -- predicate matches the partial index on date_recorded WHERE is_hot
+    UPDATE prices
+    SET is_hot = false, hotness_score = NULL
+    WHERE date_recorded >= date_trunc('day', now() AT TIME ZONE 'utc')
+      AND is_hot;
+
+    SELECT run_id INTO v_run_id
+    FROM prices
+    ORDER BY date_recorded DESC
+    LIMIT 1;
+
+    IF v_run_id IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    CREATE TEMP TABLE hot_candidates ON COMMIT DROP AS
+    SELECT p.price_id, p.smartphone_id, p.retailer_id, p.price,
+           r.relevance_status,
+           row_number() OVER (PARTITION BY p.smartphone_id
+                              ORDER BY p.price, p.price_id) AS rn
+    FROM prices p
+    JOIN retailers r USING (retailer_id)
+    WHERE p.run_id = v_run_id
+      AND NOT p.price_error
+      AND p.price > 0
+      AND r.relevance_status IN ('VERIFIED', 'ACTIVE');
+
+    CREATE TEMP TABLE hot_agg ON COMMIT DROP AS
+    SELECT smartphone_id,
+           avg(price) AS avg_top_5,
+           count(DISTINCT retailer_id) AS unique_retailers,
+           count(*) FILTER (WHERE relevance_status = 'VERIFIED') AS verified_count,
+           count(*) AS top_n
+    FROM hot_candidates
+    WHERE rn <= 5
+    GROUP BY smartphone_id;
+
+    UPDATE prices p
+    SET is_hot = true,
+        hotness_score = round((a.avg_top_5 - c.price) / a.avg_top_5 * 100, 2)
+    FROM hot_candidates c
+    JOIN hot_agg a USING (smartphone_id)
+    WHERE p.price_id = c.price_id
+      AND a.top_n >= 5
+      AND a.unique_retailers >= 2
+      AND a.verified_count >= 1
+      AND c.price < a.avg_top_5 * 0.85;
+    GET DIAGNOSTICS updated = ROW_COUNT;
+    RETURN updated;
+END;
+$$;
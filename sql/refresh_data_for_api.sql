@@ -0,0 +1,39 @@
+-- Rebuild data_for_api for one run entirely server-side: truncate, then
+-- insert straight from the data_for_api_source view. This replaces the
+-- whole paginate/process/insert loop in update_api_data.py with a single
+-- round trip; the Python paged path remains only as a fallback.
+--
+-- DISTINCT ON mirrors the Python-side dedup on (smartphone_id,
+-- retailer_id, price), split_part mirrors clean_product_url, and the
+-- WHERE clause mirrors the price-range and URL-shape validation.
+--
+-- Called from update_api_data.py via:
+--   supabase.rpc('refresh_data_for_api', {'p_run_id': run_id})
+
+CREATE OR REPLACE FUNCTION refresh_data_for_api(p_run_id uuid)
+RETURNS integer
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+    inserted integer;
+BEGIN
+    TRUNCATE TABLE data_for_api;
+    INSERT INTO data_for_api (
+        price_id, run_id, smartphone_id, retailer_id, retailer_name,
+        price, product_url, is_hot, hotness_score, oem, model,
+        color_variant, ram_variant, rom_variant, variant_rank, os
+    )
+    SELECT DISTINCT ON (smartphone_id, retailer_id, price)
+        price_id, run_id, smartphone_id, retailer_id, retailer_name,
+        price, split_part(product_url, '?', 1), is_hot, hotness_score,
+        oem, model, color_variant, ram_variant, rom_variant, variant_rank, os
+    FROM data_for_api_source
+    WHERE run_id = p_run_id
+      AND price BETWEEN 0 AND 100000
+      AND (product_url IS NULL OR product_url LIKE 'http%')
+    ORDER BY smartphone_id, retailer_id, price, price_id;
+    GET DIAGNOSTICS inserted = ROW_COUNT;
+    RETURN inserted;
+END;
+$$;
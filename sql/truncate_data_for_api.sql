@@ -0,0 +1,15 @@
+-- Empty data_for_api in one O(1) statement before a rebuild. The table is
+-- fully repopulated from the current run, so truncating replaces the pair
+-- of DELETE scans (current run + previous runs) the scripts used to issue,
+-- and leaves no dead tuples behind for autovacuum.
+--
+-- Called from update_api_data.py via:
+--   supabase.rpc('truncate_data_for_api')
+
+CREATE OR REPLACE FUNCTION truncate_data_for_api()
+RETURNS void
+LANGUAGE sql
+SECURITY DEFINER
+AS $$
+    TRUNCATE TABLE data_for_api;
+$$;
@@ -0,0 +1,37 @@
+-- Bulk-apply hot flags through an unlogged staging table. Chunked upserts
+-- still pay a B-tree update per row; here the whole payload is unpacked
+-- once with jsonb_to_recordset into hot_staging and applied with a single
+-- UPDATE ... FROM join, then the staging table is truncated for the next
+-- run. Unlogged skips WAL for the staging rows, which are throwaway.
+--
+-- Called from update_hot_prices.py via:
+--   supabase.rpc('upsert_hot', {'payload': [...]})
+
+CREATE UNLOGGED TABLE IF NOT EXISTS hot_staging (
+    price_id bigint PRIMARY KEY,
+    score numeric
+);
+
+CREATE OR REPLACE FUNCTION upsert_hot(payload jsonb)
+RETURNS integer
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+    updated integer;
+BEGIN
+    TRUNCATE hot_staging;
+    INSERT INTO hot_staging (price_id, score)
+    SELECT price_id, score
+    FROM jsonb_to_recordset(payload) AS t(price_id bigint, score numeric);
+
+    UPDATE prices p
+    SET is_hot = true, hotness_score = s.score
+    FROM hot_staging s
+    WHERE p.price_id = s.price_id;
+    GET DIAGNOSTICS updated = ROW_COUNT;
+
+    TRUNCATE hot_staging;
+    RETURN updated;
+END;
+$$;
@@ -0,0 +1,27 @@
+import os
+from dotenv import load_dotenv
+import asyncpg
+
+# Load environment variables
+load_dotenv()
+
+# Supabase's transaction pooler (Supavisor) hands each transaction a
+# different backend connection, so server-side prepared statements
+# accumulated by asyncpg either error out or silently degrade throughput.
+# Every direct-Postgres connection in this project must go through this
+# factory so the statement cache stays disabled.
+
+async def create_db_pool(min_size: int = 1, max_size: int = 10) -> asyncpg.Pool:
+    """Create an asyncpg pool configured for the Supabase transaction pooler.
+
+    Disables asyncpg's prepared-statement cache (statement_cache_size=0,
+    max_cacheable_statement_size=0), which is required for pooler
+    compatibility. Use this instead of calling asyncpg.create_pool directly.
+    """
+    return await asyncpg.create_pool(
+        os.getenv('DB_CONNECTION_STRING'),
+        min_size=min_size,
+        max_size=max_size,
+        statement_cache_size=0,
+        max_cacheable_statement_size=0
+    )
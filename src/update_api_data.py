@@ -1,10 +1,15 @@
 import os
 from dotenv import load_dotenv
 import logging
+import httpx
+import orjson
 from supabase import create_client, Client
 from typing import List, Dict, Optional, Tuple, Set
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import time
+import random
 import re
 from urllib.parse import urlparse
 
@@ -60,16 +65,63 @@ supabase: Client = create_client(
     os.getenv('SUPABASE_KEY')
 )
 
+# Connection pool limits shared by every request this script makes: enough
+# keepalive slots for the parallel insert workers plus the prefetcher, so
+# repeated queries reuse warm TLS connections instead of re-handshaking.
+POOL_LIMITS = httpx.Limits(max_connections=16, max_keepalive_connections=16, keepalive_expiry=60)
+
+# Swap the supabase-py session for one with the tuned pool, preserving the
+# base URL and auth headers the client configured
+supabase.postgrest.session = httpx.Client(
+    base_url=supabase.postgrest.session.base_url,
+    headers=supabase.postgrest.session.headers,
+    limits=POOL_LIMITS,
+    timeout=30
+)
+
+# Pooled client for the direct data_for_api POSTs
+http_client = httpx.Client(limits=POOL_LIMITS, timeout=30)
+
+# Direct PostgREST endpoint for data_for_api inserts. Batches are serialized
+# once with orjson and posted in a single request, bypassing the client
+# library's per-row serialization pass. on_conflict + merge-duplicates turns
+# the POST into an atomic upsert keyed on price_id (the table's primary key),
+# so no delete-first round trip is needed.
+DATA_FOR_API_ENDPOINT = f"{os.getenv('SUPABASE_URL')}/rest/v1/data_for_api?on_conflict=price_id"
+POSTGREST_HEADERS = {
+    'apikey': os.getenv('SUPABASE_KEY'),
+    'Authorization': f"Bearer {os.getenv('SUPABASE_KEY')}",
+    'Content-Type': 'application/json',
+    'Prefer': 'resolution=merge-duplicates,return=minimal'
+}
+
+# Column order for data_for_api rows. Rows are built as tuples in this order
+# (a tuple allocates far less than an equally sized dict and the payload does
+# not repeat the key strings for every row); the bulk insert RPC unpacks the
+# positional arrays server-side.
+DATA_FOR_API_COLUMNS = (
+    'price_id', 'run_id', 'smartphone_id', 'retailer_id', 'retailer_name',
+    'price', 'product_url', 'is_hot', 'hotness_score', 'oem', 'model',
+    'color_variant', 'ram_variant', 'rom_variant', 'variant_rank', 'os'
+)
+
+def rows_to_dicts(rows: List[tuple]) -> List[Dict]:
+    """Convert positional rows back to dicts keyed by DATA_FOR_API_COLUMNS"""
+    return [dict(zip(DATA_FOR_API_COLUMNS, row)) for row in rows]
+
 class Config:
     """Configuration settings for the script"""
     # Batch processing
     BATCH_SIZE = 1000  # For batching inserts
     PAGE_SIZE = 5000  # Increased from 1000 to reduce round trips
+    INSERT_WORKERS = 8  # Concurrent insert requests (and max in flight)
     
     # Retry settings
     MAX_RETRIES = 3
-    RETRY_DELAY = 1  # seconds
-    
+    RETRY_DELAY = 1  # seconds, base for exponential backoff
+    MAX_RETRY_DELAY = 30  # seconds, backoff cap
+    RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
     # Validation
     MIN_PRICE = 0
     MAX_PRICE = 100000
@@ -77,19 +129,33 @@ class Config:
         r'^https?://[^\s/$.?#].[^\s]*$'  # Basic URL validation
     ]
 
-def retry_on_error(max_retries: int = Config.MAX_RETRIES, delay: int = Config.RETRY_DELAY):
-    """Decorator to retry operations on failure"""
+# Compiled once at import time; going through re.match would pay a cache
+# lookup and pattern hash on every call
+_URL_REGEXES = [re.compile(pattern) for pattern in Config.URL_PATTERNS]
+
+def retry_on_error(max_retries: int = Config.MAX_RETRIES, delay: float = Config.RETRY_DELAY):
+    """Decorator to retry transient failures with jittered exponential backoff.
+
+    Only transport errors and retryable HTTP statuses (429, 5xx) are retried;
+    permanent failures such as validation errors or other 4xx responses are
+    re-raised immediately without sleeping.
+    """
     def decorator(func):
         def wrapper(*args, **kwargs):
             last_error = None
             for attempt in range(max_retries):
                 try:
                     return func(*args, **kwargs)
-                except Exception as e:
+                except httpx.HTTPStatusError as e:
+                    if e.response.status_code not in Config.RETRYABLE_STATUS_CODES:
+                        raise
+                    last_error = e
+                except httpx.TransportError as e:
                     last_error = e
-                    if attempt < max_retries - 1:
-                        logger.warning(f"Attempt {attempt + 1} failed: {str(e)}. Retrying in {delay} seconds...")
-                        time.sleep(delay)
+                if attempt < max_retries - 1:
+                    backoff = min(Config.MAX_RETRY_DELAY, delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+                    logger.warning(f"Attempt {attempt + 1} failed: {str(last_error)}. Retrying in {backoff:.1f} seconds...")
+                    time.sleep(backoff)
             logger.error(f"All {max_retries} attempts failed. Last error: {str(last_error)}")
             raise last_error
         return wrapper
@@ -113,19 +179,37 @@ def validate_url(url: str) -> bool:
         result = urlparse(url)
         if not all([result.scheme, result.netloc]):
             return False
-        return any(re.match(pattern, url) for pattern in Config.URL_PATTERNS)
+        return any(regex.match(url) for regex in _URL_REGEXES)
     except Exception:
         return False
 
 def clean_product_url(url: str) -> str:
     """Clean product URL by removing query parameters"""
-    if not url:
-        return url
-    return url.split('?')[0] if '?' in url else url
+    # partition scans the string once and needs no pre-check: without a '?'
+    # it returns (url, '', '')
+    return url.partition('?')[0] if url else url
+
+def _or_filter(query, conditions: str):
+    """Apply a PostgREST or= disjunction to a select builder.
+
+    The postgrest version pinned by supabase 2.0.3 predates the or_()
+    builder method, so the filter is added to the request's query params
+    directly, in the same wire format or_() produces on newer versions.
+    """
+    query.params = query.params.add('or', f'({conditions})')
+    return query
+
+# Memoized run_id for the lifetime of the process: every stage of one
+# invocation must work on the same run. Only successful lookups are cached,
+# so a transient failure at startup is retried rather than pinned as None
+_latest_run_id: Optional[str] = None
 
 @retry_on_error()
 def get_latest_run_id() -> Optional[str]:
-    """Get the latest run_id from prices table"""
+    """Get the latest run_id from prices table (memoized on success)"""
+    global _latest_run_id
+    if _latest_run_id is not None:
+        return _latest_run_id
     try:
         # Get the run_id with the latest date_recorded timestamp
         result = supabase.table('prices').select(
@@ -142,55 +226,67 @@ def get_latest_run_id() -> Optional[str]:
             
         run_id = result.data[0]['run_id']
         logger.info(f"Using latest run_id: {run_id} (recorded at: {result.data[0]['date_recorded']})")
+        _latest_run_id = run_id
         return run_id
     except Exception as e:
         logger.error(f"Error getting latest run_id: {e}")
         return None
 
 @retry_on_error()
-def get_valid_prices(run_id: str, page: int) -> Tuple[List[Dict], bool]:
-    """Get a page of valid prices, ordered by smartphone_id, retailer_id, price to ensure consistent selection"""
+def get_valid_prices(run_id: str, cursor: Optional[tuple]) -> Tuple[List[Dict], bool, Optional[tuple]]:
+    """Get a page of valid, pre-joined rows from the data_for_api_source view
+    using keyset pagination.
+
+    `cursor` is the (smartphone_id, retailer_id, price, price_id) tuple
+    returned by the previous call, or None for the first page. Seeking past
+    the cursor avoids OFFSET's scan-and-discard cost, which grows with the
+    page number; price_id is included in the ordering as a unique tiebreaker.
+    A full page (len == PAGE_SIZE) signals that more data may follow, so no
+    separate probe query is needed.
+    """
     try:
-        offset = page * Config.PAGE_SIZE
-        logger.debug(f"Fetching prices with offset {offset}, run_id {run_id}")
-        
-        # Use a single query with all necessary filters
-        result = (supabase.table('prices')
-                 .select('*')
+        logger.debug(f"Fetching prices after cursor {cursor}, run_id {run_id}")
+
+        # The view already joins smartphones/retailers and filters out
+        # error/null prices; validation of price range and URL shape stays
+        # server-side so invalid rows never leave the database
+        query = (supabase.table('data_for_api_source')
+                 .select(','.join(DATA_FOR_API_COLUMNS))
                  .eq('run_id', run_id)
-                 .eq('price_error', False)
-                 .not_.is_('price', 'null')  
-                 .order('smartphone_id')
-                 .order('retailer_id')
-                 .order('price')
-                 .limit(Config.PAGE_SIZE)
-                 .offset(offset)
-                 .execute())
-        
-        if not hasattr(result, 'data'):
-            logger.error("No data returned from prices query")
-            return [], False
-            
-        # Check if there are more pages by requesting one more record
-        next_page = (supabase.table('prices')
-                    .select('price_id')
-                    .eq('run_id', run_id)
-                    .eq('price_error', False)
-                    .not_.is_('price', 'null')  
-                    .order('smartphone_id')
-                    .order('retailer_id')
-                    .order('price')
-                    .limit(1)
-                    .offset(offset + Config.PAGE_SIZE)
-                    .execute())
-        
-        has_more = bool(next_page.data) if hasattr(next_page, 'data') else False
-        logger.info(f"Retrieved {len(result.data)} records for page {page} (has more: {has_more})")
-        
-        return result.data, has_more
+                 .gte('price', Config.MIN_PRICE)
+                 .lte('price', Config.MAX_PRICE))
+        query = _or_filter(query, 'product_url.is.null,product_url.like.http*')
+
+        if cursor is not None:
+            s, r, p, pid = cursor
+            query = _or_filter(
+                query,
+                f'smartphone_id.gt.{s},'
+                f'and(smartphone_id.eq.{s},retailer_id.gt.{r}),'
+                f'and(smartphone_id.eq.{s},retailer_id.eq.{r},price.gt.{p}),'
+                f'and(smartphone_id.eq.{s},retailer_id.eq.{r},price.eq.{p},price_id.gt.{pid})'
+            )
+
+        result = (query
+                  .order('smartphone_id')
+                  .order('retailer_id')
+                  .order('price')
+                  .order('price_id')
+                  .limit(Config.PAGE_SIZE)
+                  .execute())
+
+        if not hasattr(result, 'data') or not result.data:
+            return [], False, cursor
+
+        last = result.data[-1]
+        next_cursor = (last['smartphone_id'], last['retailer_id'], last['price'], last['price_id'])
+        has_more = len(result.data) == Config.PAGE_SIZE
+        logger.info(f"Retrieved {len(result.data)} records (has more: {has_more})")
+
+        return result.data, has_more, next_cursor
     except Exception as e:
         logger.error(f"Error getting valid prices: {e}")
-        return [], False
+        return [], False, cursor
 
 @retry_on_error()
 def get_smartphones(smartphone_ids: List[int]) -> Optional[Dict]:
@@ -227,7 +323,7 @@ def get_retailers(retailer_ids: List[int]) -> Optional[Dict]:
         return None
 
 @retry_on_error()
-def get_existing_hotness_data(smartphone_ids: List[int], retailer_ids: List[int]) -> Dict[str, Dict]:
+def get_existing_hotness_data(smartphone_ids: List[int], retailer_ids: List[int]) -> Dict[tuple, Dict]:
     """Get existing hotness data from data_for_api table"""
     try:
         result = (supabase.table('data_for_api')
@@ -235,13 +331,14 @@ def get_existing_hotness_data(smartphone_ids: List[int], retailer_ids: List[int]
                  .in_('smartphone_id', smartphone_ids)
                  .in_('retailer_id', retailer_ids)
                  .execute())
-        
+
         if not result.data:
             return {}
-            
-        # Create lookup dictionary using smartphone_id-retailer_id as key
+
+        # Create lookup dictionary keyed by (smartphone_id, retailer_id);
+        # tuples hash the underlying ints directly with no string formatting
         return {
-            f"{item['smartphone_id']}-{item['retailer_id']}": {
+            (item['smartphone_id'], item['retailer_id']): {
                 'is_hot': item.get('is_hot', False),
                 'hotness_score': item.get('hotness_score', 0)
             }
@@ -251,48 +348,98 @@ def get_existing_hotness_data(smartphone_ids: List[int], retailer_ids: List[int]
         logger.error(f"Error getting existing hotness data: {e}")
         return {}
 
-def insert_data_batch(batch: List[Dict]) -> bool:
-    """Insert a batch of data into data_for_api table"""
+def delete_old_records(run_id: str) -> None:
+    """Delete data_for_api records from previous runs in short chunked transactions"""
     try:
-        # First, delete any existing records with these price_ids to avoid conflicts
-        price_ids = [item['price_id'] for item in batch]
-        if price_ids:
-            try:
-                delete_result = supabase.table('data_for_api').delete().in_('price_id', price_ids).execute()
-                logger.debug(f"Deleted {len(price_ids)} existing records")
-            except Exception as e:
-                logger.warning(f"Error deleting existing records: {e}")
-        
-        # Then insert new records
-        try:
-            result = supabase.table('data_for_api').insert(batch).execute()
-            if hasattr(result, 'error') and result.error:
-                if 'duplicate key value violates unique constraint' in str(result.error):
-                    logger.warning(f"Duplicate key violation for price_ids: {price_ids}")
-                    # Try one by one to identify problematic records
-                    success_count = 0
-                    for item in batch:
-                        try:
-                            single_result = supabase.table('data_for_api').insert([item]).execute()
-                            if not (hasattr(single_result, 'error') and single_result.error):
-                                success_count += 1
-                        except Exception as e:
-                            logger.warning(f"Failed to insert price_id {item['price_id']}: {e}")
-                    return success_count > 0
-                else:
-                    logger.error(f"Error inserting batch: {result.error}")
-                    return False
-            return True
-        except Exception as e:
-            logger.error(f"Error inserting batch: {e}")
-            return False
-            
+        result = supabase.rpc('delete_old_data_for_api', {'keep_run_id': run_id}).execute()
+        logger.debug(f"Chunked delete removed {result.data} old records")
+    except Exception as e:
+        logger.warning(f"Chunked delete RPC failed, falling back to single DELETE: {e}")
+        delete_result = supabase.table('data_for_api').delete().neq('run_id', run_id).execute()
+        logger.debug(f"Delete result: {delete_result}")
+
+# Sentinel that matches no real run, so a single neq() delete clears everything
+NIL_RUN_ID = '00000000-0000-0000-0000-000000000000'
+
+def clear_data_for_api() -> None:
+    """Empty data_for_api before a rebuild.
+
+    The table is repopulated in full from the current run, so a single
+    TRUNCATE replaces the two DELETE scans (current run + previous runs)
+    that used to run back to back. Falls back to the chunked delete when
+    the RPC is not installed.
+    """
+    try:
+        # params is a required positional on Client.rpc in supabase 2.0.3
+        supabase.rpc('truncate_data_for_api', {}).execute()
+        logger.debug("Truncated data_for_api")
     except Exception as e:
-        logger.error(f"Error in insert_data_batch: {e}")
+        logger.warning(f"Truncate RPC failed, falling back to delete: {e}")
+        delete_old_records(NIL_RUN_ID)
+
+@retry_on_error()
+def _post_encoded_batch(body: bytes) -> None:
+    """POST a pre-encoded batch body; retries reuse the same bytes"""
+    response = http_client.post(DATA_FOR_API_ENDPOINT, content=body, headers=POSTGREST_HEADERS)
+    response.raise_for_status()
+
+def post_data_for_api(batch: List[Dict]) -> bool:
+    """POST a batch to data_for_api, serialized once with orjson.
+
+    The body is encoded before the retry loop, so a transient 5xx never
+    pays for re-serializing the same rows.
+    """
+    try:
+        _post_encoded_batch(orjson.dumps(batch))
+        return True
+    except httpx.HTTPStatusError as e:
+        logger.error(f"Error posting batch to data_for_api: {e.response.status_code} {e.response.text}")
+        return False
+    except Exception as e:
+        logger.error(f"Error posting batch to data_for_api: {e}")
         return False
 
+def refresh_data_for_api_via_rpc(run_id: str) -> Optional[int]:
+    """Rebuild data_for_api for a run in one server-side statement.
+
+    Returns the inserted row count, or None when the RPC is not installed
+    and the paged Python path should run instead.
+    """
+    try:
+        result = supabase.rpc('refresh_data_for_api', {'p_run_id': run_id}).execute()
+        return result.data
+    except Exception as e:
+        logger.warning(f"refresh_data_for_api RPC unavailable, using paged path: {e}")
+        return None
+
+def insert_page_bulk(rows: List[tuple]) -> bool:
+    """Insert a page of positional rows in a single transaction via the bulk upsert RPC"""
+    try:
+        result = supabase.rpc('insert_data_for_api_bulk', {'rows': rows}).execute()
+        logger.debug(f"Bulk upsert wrote {result.data} rows")
+        return True
+    except Exception as e:
+        logger.warning(f"Bulk insert RPC failed, falling back to batched POSTs: {e}")
+        success = True
+        for i in range(0, len(rows), Config.BATCH_SIZE):
+            if not post_data_for_api(rows_to_dicts(rows[i:i + Config.BATCH_SIZE])):
+                success = False
+        return success
+
+def insert_data_batch(batch: List[Dict]) -> bool:
+    """Upsert a batch of data into data_for_api table.
+
+    The POST is an atomic upsert on price_id, so duplicates are resolved
+    server-side and no delete-first or row-by-row retry pass is needed.
+    """
+    return post_data_for_api(batch)
+
 def safe_convert_hotness_score(score) -> int:
     """Safely convert hotness score to integer"""
+    # Fast path: int4 columns already deserialize as int, so the common case
+    # skips the float conversion and exception handler entirely
+    if type(score) is int:
+        return score
     try:
         if score is None:
             return 0
@@ -301,123 +448,83 @@ def safe_convert_hotness_score(score) -> int:
     except (TypeError, ValueError):
         return 0
 
-def get_existing_product_keys(run_id: str) -> Set[str]:
-    """Get set of existing product keys to avoid duplicates"""
+def get_existing_product_keys(run_id: str) -> Set[tuple]:
+    """Get set of existing (smartphone_id, retailer_id, price) keys to avoid duplicates"""
     try:
         result = supabase.table('data_for_api').select('smartphone_id,retailer_id,price').eq('run_id', run_id).execute()
         if hasattr(result, 'data'):
-            return {f"{item['smartphone_id']}-{item['retailer_id']}-{item['price']}" for item in result.data}
+            return {(item['smartphone_id'], item['retailer_id'], item['price']) for item in result.data}
         return set()
     except Exception as e:
         logger.error(f"Error getting existing product keys: {e}")
         return set()
 
-def process_price_batch(prices: List[Dict], run_id: str, processed_price_ids: Set[str]) -> Tuple[List[Dict], int]:
-    """Process a batch of prices and return prepared data and skip count"""
+def process_price_batch(prices: List[Dict], run_id: str, last_key: Optional[tuple]) -> Tuple[List[tuple], int, Optional[tuple]]:
+    """Dedup a batch of pre-joined view rows and build positional tuples.
+
+    Rows arrive from data_for_api_source already joined, filtered and in the
+    final column shape, so all that remains is URL cleaning and duplicate
+    detection. Duplicates are found with a single last-seen (smartphone_id,
+    retailer_id, price) tuple: the query orders by exactly these columns, so
+    duplicate rows arrive adjacent and O(1) state is enough. Callers pass the
+    returned key back in to preserve adjacency across batch and page
+    boundaries.
+    """
     data_for_api = []
     total_skipped = 0
-    
-    # Get all IDs for batch verification
-    price_ids = [price['price_id'] for price in prices]
-    smartphone_ids = list(set(price['smartphone_id'] for price in prices))
-    retailer_ids = list(set(price['retailer_id'] for price in prices))
-    
-    # Verify all prices in batch with a single query
-    verify_result = (supabase.table('prices')
-                    .select('price_id,price_error,price,product_url,is_hot,hotness_score')
-                    .in_('price_id', price_ids)
-                    .execute())
-    
-    if not verify_result.data:
-        logger.warning(f"Could not verify {len(price_ids)} prices, skipping batch")
-        return [], len(price_ids)
-    
-    # Get smartphone data
-    smartphones_result = (supabase.table('smartphones')
-                        .select('smartphone_id,oem,model,color_variant,ram_variant,rom_variant,variant_rank,os')
-                        .in_('smartphone_id', smartphone_ids)
-                        .execute())
-    
-    if not smartphones_result.data:
-        logger.warning(f"Could not get smartphone data for {len(smartphone_ids)} smartphones, skipping batch")
-        return [], len(price_ids)
-
-    # Get retailer data
-    retailers_result = (supabase.table('retailers')
-                       .select('retailer_id,retailer_name')
-                       .in_('retailer_id', retailer_ids)
-                       .execute())
-    
-    if not retailers_result.data:
-        logger.warning(f"Could not get retailer data for {len(retailer_ids)} retailers, skipping batch")
-        return [], len(retailer_ids)
-        
-    # Create lookup dictionaries
-    verified_prices = {p['price_id']: p for p in verify_result.data}
-    smartphones = {s['smartphone_id']: s for s in smartphones_result.data}
-    retailers = {r['retailer_id']: r for r in retailers_result.data}
-    
+
+    # The source query supplies every column we insert; fail loudly if it
+    # ever drifts out of sync with DATA_FOR_API_COLUMNS
+    if prices:
+        missing = [col for col in DATA_FOR_API_COLUMNS if col not in prices[0]]
+        assert not missing, f"price rows missing expected columns: {missing}"
+
+    # Hoist bound methods out of the hot loop (LOAD_FAST vs attribute lookup
+    # per iteration)
+    append = data_for_api.append
+    debug = logger.debug
+
     for price in prices:
         price_id = price['price_id']
         smartphone_id = price['smartphone_id']
         retailer_id = price['retailer_id']
-        
-        # Skip if already processed
-        if price_id in processed_price_ids:
-            logger.debug(f"Skipping already processed price_id: {price_id}")
-            total_skipped += 1
-            continue
-            
-        # Check verification result
-        verified_price = verified_prices.get(price_id)
-        if not verified_price or verified_price['price_error'] or verified_price['price'] is None:
-            logger.debug(f"Price {price_id} failed verification")
-            total_skipped += 1
-            continue
-            
-        # Get smartphone data
-        smartphone = smartphones.get(smartphone_id)
-        if not smartphone:
-            logger.debug(f"No smartphone data found for smartphone_id {smartphone_id}")
-            total_skipped += 1
-            continue
 
-        # Get retailer data
-        retailer = retailers.get(retailer_id)
-        if not retailer:
-            logger.debug(f"No retailer data found for retailer_id {retailer_id}")
+        # Skip duplicates of the previous row (rows are ordered by this key)
+        key = (smartphone_id, retailer_id, price['price'])
+        if key == last_key:
+            debug(f"Skipping duplicate price_id: {price_id}")
             total_skipped += 1
             continue
-            
-        # Process valid price
+        last_key = key
+
         try:
-            # Clean the product URL by removing tracking parameters
-            product_url = clean_product_url(verified_price.get('product_url', ''))
-            
-            data_for_api.append({
-                'price_id': price_id,
-                'run_id': run_id,
-                'smartphone_id': smartphone_id,
-                'retailer_id': retailer_id,
-                'retailer_name': retailer['retailer_name'],
-                'price': price['price'],
-                'product_url': product_url,  # Use cleaned URL
-                'is_hot': verified_price.get('is_hot', False),  # Get from prices table
-                'hotness_score': safe_convert_hotness_score(verified_price.get('hotness_score')),  # Convert to integer
-                'oem': smartphone['oem'],
-                'model': smartphone['model'],
-                'color_variant': smartphone.get('color_variant', None),  # Optional field
-                'ram_variant': smartphone.get('ram_variant', None),  # Optional field
-                'rom_variant': smartphone.get('rom_variant', None),  # Optional field
-                'variant_rank': smartphone.get('variant_rank', None),  # Optional field
-                'os': smartphone.get('os', None)  # Optional field
-            })
-            processed_price_ids.add(price_id)
+            # Positional row in DATA_FOR_API_COLUMNS order, with tracking
+            # parameters stripped from the product URL
+            append((
+                price_id,
+                run_id,
+                smartphone_id,
+                retailer_id,
+                price['retailer_name'],
+                price['price'],
+                clean_product_url(price.get('product_url', '')),
+                price.get('is_hot', False),
+                # The view delivers ints (the fast path); raw-table rows can
+                # still carry floats or NULL
+                safe_convert_hotness_score(price.get('hotness_score')),
+                price['oem'],
+                price['model'],
+                price.get('color_variant', None),  # Optional field
+                price.get('ram_variant', None),  # Optional field
+                price.get('rom_variant', None),  # Optional field
+                price.get('variant_rank', None),  # Optional field
+                price.get('os', None)  # Optional field
+            ))
         except Exception as e:
             logger.error(f"Error processing price {price_id}: {str(e)}")
             total_skipped += 1
-            
-    return data_for_api, total_skipped
+
+    return data_for_api, total_skipped, last_key
 
 def update_data_for_api() -> bool:
     """Update the data_for_api table with the latest price data"""
@@ -426,85 +533,100 @@ def update_data_for_api() -> bool:
     
     try:
         # Get the latest run_id
-        latest_run = supabase.table('prices').select('run_id,date_recorded').order('date_recorded', desc=True).limit(1).execute()
-        if not latest_run.data:
+        run_id = get_latest_run_id()
+        if not run_id:
             logger.error("No price data found")
             return False
-        
-        run_id = latest_run.data[0]['run_id']
-        date_recorded = latest_run.data[0]['date_recorded']
-        logger.info(f"Using latest run_id: {run_id} (recorded at: {date_recorded})")
-        
-        # Delete existing records for the current run_id
-        logger.info("Deleting existing records for the current run_id...")
-        delete_result = supabase.table('data_for_api').delete().eq('run_id', run_id).execute()
-        logger.debug(f"Delete result: data={delete_result.data} count={delete_result.count}")
-        
-        # Delete old records from previous runs
-        logger.info("Deleting old records from previous runs...")
-        delete_result = supabase.table('data_for_api').delete().neq('run_id', run_id).execute()
-        logger.debug(f"Delete result: {delete_result}")
-        
-        # Get total count for progress reporting
-        count_result = (supabase.table('prices')
-                       .select('count', count='exact')
+
+        # Fast path: rebuild the whole table server-side in one round trip
+        # (the RPC truncates and repopulates inside one transaction)
+        inserted = refresh_data_for_api_via_rpc(run_id)
+        if inserted is not None:
+            print(f"Rebuilt data_for_api with {inserted} records")
+            logger.info(f"Rebuilt data_for_api with {inserted} records in {time.time() - start_time:.1f} seconds")
+            return True
+
+        # Clear out all existing records (current and previous runs) in one go
+        print("Cleaning up old records...")
+        logger.info("Clearing existing data_for_api records...")
+        clear_data_for_api()
+
+        # Get total count for progress reporting. The pinned postgrest has no
+        # head=True support, so ask for the exact count while limiting the
+        # body to a single narrow row
+        count_query = (supabase.table('data_for_api_source')
+                       .select('price_id', count='exact')
                        .eq('run_id', run_id)
-                       .eq('price_error', False)
-                       .not_.is_('price', 'null')
-                       .execute())
+                       .gte('price', Config.MIN_PRICE)
+                       .lte('price', Config.MAX_PRICE)
+                       .limit(1))
+        count_result = _or_filter(
+            count_query, 'product_url.is.null,product_url.like.http*'
+        ).execute()
         total_count = count_result.count if hasattr(count_result, 'count') else 0
+        print(f"\nProcessing {total_count} records...")
         logger.info(f"Total valid records to process: {total_count}")
-        
+
         # Process data in pages
-        page = 0
+        cursor = None
         total_processed = 0
         total_skipped = 0
-        processed_price_ids = set()
-        current_batch = []
-        
-        while True:
-            # Get a page of prices
-            prices, has_more = get_valid_prices(run_id, page)
-            if not prices:
-                break
-                
-            # Process prices in batches
-            current_batch.extend(prices)
-            while len(current_batch) >= Config.BATCH_SIZE:
-                batch = current_batch[:Config.BATCH_SIZE]
-                current_batch = current_batch[Config.BATCH_SIZE:]
-                
-                data_for_api, skipped = process_price_batch(batch, run_id, processed_price_ids)
-                total_skipped += skipped
-                
-                if data_for_api:
-                    try:
-                        insert_result = supabase.table('data_for_api').insert(data_for_api).execute()
-                        total_processed += len(data_for_api)
-                    except Exception as e:
-                        logger.error(f"Error inserting batch: {e}")
-                        total_skipped += len(data_for_api)
-                
+        last_key = None
+
+        # Prefetch one page ahead so the next fetch is in flight while the
+        # current page is processed, and run inserts on a worker pool so
+        # multiple pages can be in flight at once (bounded by INSERT_WORKERS)
+        with ThreadPoolExecutor(max_workers=1) as prefetcher, \
+             ThreadPoolExecutor(max_workers=Config.INSERT_WORKERS) as insert_pool:
+            in_flight = deque()
+            future = prefetcher.submit(get_valid_prices, run_id, cursor)
+            while True:
+                # Get a page of prices
+                prices, has_more, cursor = future.result()
+                if not prices:
+                    break
+
+                # Kick off the next fetch before doing any CPU work
+                if has_more:
+                    future = prefetcher.submit(get_valid_prices, run_id, cursor)
+
+                # Process the page in batches, collecting rows for one bulk insert
+                page_rows = []
+                for i in range(0, len(prices), Config.BATCH_SIZE):
+                    batch = prices[i:i + Config.BATCH_SIZE]
+                    data_for_api, skipped, last_key = process_price_batch(batch, run_id, last_key)
+                    total_skipped += skipped
+                    page_rows.extend(data_for_api)
+
+                # Submit the page insert, waiting for the oldest in-flight
+                # insert first so at most INSERT_WORKERS are outstanding
+                if page_rows:
+                    if len(in_flight) >= Config.INSERT_WORKERS:
+                        insert_future, count = in_flight.popleft()
+                        if insert_future.result():
+                            total_processed += count
+                        else:
+                            total_skipped += count
+                    in_flight.append((insert_pool.submit(insert_page_bulk, page_rows), len(page_rows)))
+
+                print(f"Progress: {total_processed}/{total_count} records processed ({total_skipped} skipped)")
                 logger.info(f"Progress: {total_processed} records processed ({total_skipped} skipped)")
-            
-            if not has_more:
-                break
-            page += 1
-        
-        # Process remaining batch
-        if current_batch:
-            data_for_api, skipped = process_price_batch(current_batch, run_id, processed_price_ids)
-            total_skipped += skipped
-            
-            if data_for_api:
-                try:
-                    insert_result = supabase.table('data_for_api').insert(data_for_api).execute()
-                    total_processed += len(data_for_api)
-                except Exception as e:
-                    logger.error(f"Error inserting final batch: {e}")
-                    total_skipped += len(data_for_api)
-        
-        logger.info(f"Finished processing {total_processed} records in {time.time() - start_time:.1f} seconds")
+
+                if not has_more:
+                    break
+
+            # Wait for the remaining inserts
+            while in_flight:
+                insert_future, count = in_flight.popleft()
+                if insert_future.result():
+                    total_processed += count
+                else:
+                    total_skipped += count
+
+        elapsed_time = time.time() - start_time
+        print(f"\nFinished processing {total_processed} records in {elapsed_time:.1f} seconds")
+        print(f"Success: {total_processed}, Skipped: {total_skipped}")
+        logger.info(f"Finished processing {total_processed} records in {elapsed_time:.1f} seconds")
         logger.info(f"Success: {total_processed}, Skipped: {total_skipped}")
         return True
         
@@ -513,117 +635,17 @@ def update_data_for_api() -> bool:
         return False
 
 def main():
+    """Thin CLI wrapper around update_data_for_api.
+
+    The full pipeline used to be duplicated here; keeping a single
+    implementation means every optimization applies to both entry points.
+    """
     try:
         print("Starting API data update...")
-        
-        # Get the latest run_id from the prices table
-        latest_run = (supabase.table('prices')
-                     .select('run_id,date_recorded')
-                     .order('date_recorded', desc=True)
-                     .limit(1)
-                     .execute())
-        
-        if not latest_run.data:
-            logger.error("No run_id found in prices table")
-            return
-            
-        run_id = latest_run.data[0]['run_id']
-        date_recorded = latest_run.data[0]['date_recorded']
-        logger.info(f"Using latest run_id: {run_id} (recorded at: {date_recorded})")
-        
-        # Delete existing records for the current run_id
-        print("Cleaning up old records...")
-        logger.info("Deleting existing records for the current run_id...")
-        delete_result = supabase.table('data_for_api').delete().eq('run_id', run_id).execute()
-        logger.debug(f"Delete result: data={delete_result.data} count={delete_result.count}")
-        
-        # Delete old records from previous runs
-        logger.info("Deleting old records from previous runs...")
-        delete_result = supabase.table('data_for_api').delete().neq('run_id', run_id).execute()
-        logger.debug(f"Delete result: {delete_result}")
-        
-        # Get total count of valid records
-        count_result = (supabase.table('prices')
-                       .select('count')
-                       .eq('run_id', run_id)
-                       .eq('price_error', False)
-                       .not_.is_('price', 'null')
-                       .execute())
-                       
-        total_count = int(count_result.data[0]['count'])
-        print(f"\nProcessing {total_count} records...")
-        logger.info(f"Total valid records to process: {total_count}")
-        
-        # Process records in batches
-        start_time = time.time()
-        total_processed = 0
-        total_skipped = 0
-        processed_price_ids = set()
-        
-        while True:
-            # Get next batch of records
-            prices_result = (supabase.table('prices')
-                           .select('*')
-                           .eq('run_id', run_id)
-                           .eq('price_error', False)
-                           .not_.is_('price', 'null')
-                           .order('smartphone_id')
-                           .order('retailer_id')
-                           .order('price')
-                           .limit(Config.BATCH_SIZE)
-                           .offset(total_processed + total_skipped)
-                           .execute())
-            
-            # Check if there are more records after this batch
-            has_more = False
-            if prices_result.data:
-                next_result = (supabase.table('prices')
-                             .select('price_id')
-                             .eq('run_id', run_id)
-                             .eq('price_error', False)
-                             .not_.is_('price', 'null')
-                             .order('smartphone_id')
-                             .order('retailer_id')
-                             .order('price')
-                             .limit(1)
-                             .offset(total_processed + total_skipped + Config.BATCH_SIZE)
-                             .execute())
-                has_more = bool(next_result.data)
-                
-            if prices_result.data:
-                logger.debug(f"Retrieved {len(prices_result.data)} records for page {(total_processed + total_skipped) // Config.BATCH_SIZE} (has more: {has_more})")
-                
-                # Process batch
-                data_for_api, skipped = process_price_batch(prices_result.data, run_id, processed_price_ids)
-                total_skipped += skipped
-                
-                # Insert processed records
-                if data_for_api:
-                    try:
-                        insert_result = (supabase.table('data_for_api')
-                                       .insert(data_for_api)
-                                       .execute())
-                        total_processed += len(data_for_api)
-                        processed_price_ids.update(d['price_id'] for d in data_for_api)
-                    except Exception as e:
-                        logger.error(f"Error inserting batch: {e}")
-                        total_skipped += len(data_for_api)
-                
-                # Print progress every 1000 records
-                if total_processed % 1000 == 0:
-                    print(f"Progress: {total_processed}/{total_count} records processed ({total_skipped} skipped)")
-            
-            if not has_more:
-                break
-                
-        elapsed_time = time.time() - start_time
-        print(f"\nFinished processing {total_processed} records in {elapsed_time:.1f} seconds")
-        print(f"Success: {total_processed}, Skipped: {total_skipped}")
-        print("\nAPI data update complete! ")
-        
-        logger.info(f"Finished processing {total_processed} records in {elapsed_time:.1f} seconds")
-        logger.info(f"Success: {total_processed}, Skipped: {total_skipped}")
-        
+        if update_data_for_api():
+            print("\nAPI data update complete! ")
+        else:
+            print("\nAPI data update failed")
     except Exception as e:
         logger.error(f"Error in main: {str(e)}")
         print(f"\nError: {str(e)}")
@@ -1,24 +1,53 @@
+import atexit
 import os
+import queue
 from dotenv import load_dotenv
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from operator import itemgetter
 from datetime import datetime, timedelta
 from supabase import create_client, Client
+import heapq
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import httpx
+import random
 import time
+from postgrest.exceptions import APIError
 
 # Get the project root directory
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(os.path.join(PROJECT_ROOT, 'hot_prices.log')),
-        logging.StreamHandler()
-    ]
-)
+# Configure logging. Records go onto an unbounded queue and a background
+# listener thread does the formatting and file/stderr writes, so emitting a
+# log line never blocks the worker doing the actual updates
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_file_handler = logging.FileHandler(os.path.join(PROJECT_ROOT, 'hot_prices.log'))
+_file_handler.setFormatter(_log_formatter)
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(_log_formatter)
+_log_queue = queue.Queue(-1)
+_log_listener = QueueListener(_log_queue, _file_handler, _stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(_log_queue)])
 logger = logging.getLogger(__name__)
 
+# Parse response bodies with orjson where available. supabase-py goes through
+# httpx.Response.json() for every PostgREST response, so swapping that method
+# speeds up decoding of the large price pages; stdlib json remains the
+# fallback if orjson is ever missing
+try:
+    import orjson
+
+    def _orjson_response_json(self, **kwargs):
+        return orjson.loads(self.content)
+
+    httpx.Response.json = _orjson_response_json
+except ImportError:
+    pass
+
 # Load environment variables
 load_dotenv()
 
@@ -28,10 +57,24 @@ supabase: Client = create_client(
     os.getenv('SUPABASE_KEY')
 )
 
+# Swap the supabase-py session for one with a keepalive pool, preserving the
+# base URL and auth headers, so the reset/select/upsert requests reuse warm
+# TLS connections instead of re-handshaking (same setup as update_api_data.py)
+POOL_LIMITS = httpx.Limits(max_connections=8, max_keepalive_connections=8, keepalive_expiry=60)
+supabase.postgrest.session = httpx.Client(
+    base_url=supabase.postgrest.session.base_url,
+    headers=supabase.postgrest.session.headers,
+    limits=POOL_LIMITS,
+    timeout=30
+)
+
 class Config:
-    # Batch processing
-    BATCH_SIZE = 100
-    
+    # Batch processing; cost is per request rather than per row now that
+    # batches go out as a single upsert
+    BATCH_SIZE = 500
+    PAGE_SIZE = 1000  # rows per page when streaming the run's prices
+    UPDATE_WORKERS = 8  # parallel upsert requests; keep modest for rate limits
+
     # Hot price criteria
     MIN_TOP_PRICES = 5
     PRICE_THRESHOLD = 0.85  # 15% below average
@@ -41,20 +84,26 @@ class Config:
     # Retry settings
     MAX_RETRIES = 3
     RETRY_DELAY = 1  # seconds
+    MAX_RETRY_DELAY = 30  # seconds, backoff cap
 
-def retry_on_error(max_retries: int = Config.MAX_RETRIES, delay: int = Config.RETRY_DELAY):
-    """Decorator to retry operations on failure"""
+def retry_on_error(max_retries: int = Config.MAX_RETRIES, delay: float = Config.RETRY_DELAY):
+    """Decorator to retry transient failures with jittered exponential backoff.
+
+    Only API and transport errors are retried; anything else (a logic bug, a
+    bad payload) is re-raised immediately without sleeping.
+    """
     def decorator(func):
         def wrapper(*args, **kwargs):
             last_error = None
             for attempt in range(max_retries):
                 try:
                     return func(*args, **kwargs)
-                except Exception as e:
+                except (APIError, httpx.HTTPError) as e:
                     last_error = e
                     if attempt < max_retries - 1:
-                        logger.warning(f"Attempt {attempt + 1} failed: {str(e)}. Retrying in {delay} seconds...")
-                        time.sleep(delay)
+                        backoff = min(Config.MAX_RETRY_DELAY, delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+                        logger.warning(f"Attempt {attempt + 1} failed: {str(e)}. Retrying in {backoff:.1f} seconds...")
+                        time.sleep(backoff)
             logger.error(f"All {max_retries} attempts failed. Last error: {str(last_error)}")
             raise last_error
         return wrapper
@@ -65,25 +114,44 @@ def batch_update_prices(updates):
     """Update prices in batches to reduce API calls"""
     if not updates:
         return
-        
+
+    # Fast path: ship the whole update set in one RPC. The function bulk
+    # loads an unlogged staging table and flags every row with a single
+    # UPDATE ... FROM join, so no per-row upsert cost at all
+    try:
+        payload = [{'price_id': u['price_id'], 'score': u['hotness_score']}
+                   for u in updates]
+        result = supabase.rpc('upsert_hot', {'payload': payload}).execute()
+        logger.info(f"Applied {result.data} hot-price updates via staging table")
+        return
+    except Exception as e:
+        logger.warning(f"upsert_hot RPC unavailable, using chunked upserts: {e}")
+
+    def upsert_batch(batch):
+        # One upsert per batch: each row carries its own hotness_score and
+        # on_conflict resolves by price_id, so per-row round trips are gone
+        result = (supabase.table('prices')
+                 .upsert(batch, on_conflict='price_id', returning='minimal')
+                 .execute())
+
+        if getattr(result, 'error', None):
+            raise Exception(str(result.error))
+
+    batches = [updates[i:i + Config.BATCH_SIZE]
+               for i in range(0, len(updates), Config.BATCH_SIZE)]
     failed_updates = []
-    for i in range(0, len(updates), Config.BATCH_SIZE):
-        batch = updates[i:i + Config.BATCH_SIZE]
-        try:
-            # Create individual updates for each price to maintain correct hotness scores
-            for update in batch:
-                result = supabase.table('prices').update({
-                    'is_hot': True,
-                    'hotness_score': update['hotness_score']
-                }).eq('price_id', update['price_id']).execute()
-                
-                if hasattr(result, 'error') and result.error:
-                    failed_updates.append(update)
-                    logger.error(f"Error updating price {update['price_id']}: {result.error}")
-        except Exception as e:
-            failed_updates.extend(batch)
-            logger.error(f"Exception updating batch: {str(e)}")
-    
+
+    # Run the batch upserts through a bounded worker pool so their round
+    # trips overlap instead of paying the network latency once per batch
+    with ThreadPoolExecutor(max_workers=Config.UPDATE_WORKERS) as pool:
+        futures = {pool.submit(upsert_batch, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed_updates.extend(futures[future])
+                logger.error(f"Exception updating batch: {str(e)}")
+
     if failed_updates:
         logger.error(f"Failed to update {len(failed_updates)} prices")
         raise Exception(f"Failed to update {len(failed_updates)} prices")
@@ -96,128 +164,220 @@ def update_hot_prices():
     4. At least one retailer in top 5 must be verified
     """
     try:
-        # Reset hot flags and scores for today's prices
+        # Fast path: reset + recompute + update run server-side in one call
+        try:
+            # params is a required positional on Client.rpc in supabase 2.0.3
+            result = supabase.rpc('recompute_hot_prices', {}).execute()
+            logger.info(f"Recomputed hot prices server-side: {result.data} prices flagged")
+            return
+        except Exception as e:
+            logger.warning(f"recompute_hot_prices RPC unavailable, using Python path: {e}")
+
+        # Bind the constants the streaming and scoring loops touch on every
+        # iteration to locals: LOAD_FAST instead of a Config attribute lookup
+        # per row
+        page_size = Config.PAGE_SIZE
+        min_top_prices = Config.MIN_TOP_PRICES
+        price_threshold = Config.PRICE_THRESHOLD
+        min_unique_retailers = Config.MIN_UNIQUE_RETAILERS
+        min_verified_retailers = Config.MIN_VERIFIED_RETAILERS
+
+        # Reset hot flags and scores for today's prices. Only currently-hot
+        # rows need clearing (a score is never set without the flag), and the
+        # is_hot predicate lets the partial index on date_recorded WHERE
+        # is_hot serve this scan. date_recorded is deliberately left
+        # untouched: rewriting it on every row doubled the WAL/index work
+        # for no semantic gain
         today = datetime.utcnow().date().isoformat()
         reset_result = supabase.table('prices').update({
             'is_hot': False,
-            'hotness_score': None,
-            'date_recorded': datetime.utcnow().isoformat()
-        }).gte('date_recorded', today).execute()
+            'hotness_score': None
+        }).gte('date_recorded', today).eq('is_hot', True).execute()
         
-        if hasattr(reset_result, 'error') and reset_result.error:
+        if getattr(reset_result, 'error', None):
             logger.error(f"Error resetting hot prices: {reset_result.error}")
             raise Exception(f"Failed to reset hot prices: {reset_result.error}")
             
-        # Get the latest run_id
-        latest_run = supabase.table('prices').select(
-            'run_id'
-        ).order('date_recorded', desc=True).limit(1).execute()
-        
-        if hasattr(latest_run, 'error') and latest_run.error:
-            logger.error(f"Error getting latest run: {latest_run.error}")
-            raise Exception(f"Failed to get latest run: {latest_run.error}")
-            
-        if not latest_run.data:
-            logger.info("No prices found")
-            return
-            
-        latest_run_id = latest_run.data[0]['run_id']
+        # Get the latest run_id. The SQL function resolves it from
+        # max(date_recorded) via the index tail instead of sorting the whole
+        # prices table; the order-by query remains as a fallback.
+        latest_run_id = None
+        try:
+            latest_run_id = supabase.rpc('latest_run_id', {}).execute().data
+        except Exception as e:
+            logger.warning(f"latest_run_id RPC unavailable, using order-by query: {e}")
+
+        if latest_run_id is None:
+            latest_run = supabase.table('prices').select(
+                'run_id'
+            ).order('date_recorded', desc=True).limit(1).execute()
+
+            if getattr(latest_run, 'error', None):
+                logger.error(f"Error getting latest run: {latest_run.error}")
+                raise Exception(f"Failed to get latest run: {latest_run.error}")
+
+            if not latest_run.data:
+                logger.info("No prices found")
+                return
+
+            latest_run_id = latest_run.data[0]['run_id']
+
         if not latest_run_id:
             logger.info("No run_id found in latest prices")
             return
             
         logger.info(f"Processing prices from run_id: {latest_run_id}")
-        
-        # Get all prices from this run with their related data
-        latest_prices = supabase.table('prices').select(
-            'price_id,smartphone_id,retailer_id,price,date_recorded,price_error,smartphones(oem,model),retailers(relevance_status)'
-        ).eq('run_id', latest_run_id).execute()
-        
-        if hasattr(latest_prices, 'error') and latest_prices.error:
-            logger.error(f"Error getting latest prices: {latest_prices.error}")
-            raise Exception(f"Failed to get latest prices: {latest_prices.error}")
-            
-        # Process prices and calculate hot prices
-        smartphone_prices = {}
-        for price in latest_prices.data:
-            if price is None or 'price_error' not in price:
-                logger.warning(f"Skipping invalid price record: {price}")
-                continue
-                
-            if (not price['price_error'] and 
-                price.get('retailers', {}).get('relevance_status') in ['VERIFIED', 'ACTIVE']):
-                
-                if price['smartphone_id'] not in smartphone_prices:
-                    smartphone_prices[price['smartphone_id']] = []
-                    
-                smartphone_prices[price['smartphone_id']].append({
-                    'price_id': price['price_id'],
-                    'price': price['price'],
-                    'retailer_id': price['retailer_id'],
-                    'relevance_status': price['retailers']['relevance_status'],
-                    'oem': price.get('smartphones', {}).get('oem'),
-                    'model': price.get('smartphones', {}).get('model')
-                })
-        
-        # Calculate hot prices for each smartphone
+
+        # Retailer status is a small lookup table; fetching it once is far
+        # cheaper than having PostgREST embed it into every price row
+        retailer_result = supabase.table('retailers').select(
+            'retailer_id,relevance_status'
+        ).execute()
+
+        if getattr(retailer_result, 'error', None):
+            logger.error(f"Error getting retailers: {retailer_result.error}")
+            raise Exception(f"Failed to get retailers: {retailer_result.error}")
+
+        retailer_status = {r['retailer_id']: r['relevance_status']
+                           for r in retailer_result.data}
+
+        allowed_retailers = [rid for rid, status in retailer_status.items()
+                             if status in ['VERIFIED', 'ACTIVE']]
+
+        # Stream the run's prices page by page instead of loading them all.
+        # Each row is pushed into a bounded per-smartphone heap that keeps
+        # only the five cheapest prices, so memory stays O(#smartphones * 5)
+        # rather than O(#prices). Dropping the rest is safe: any price outside
+        # the top 5 is at least the 5th-cheapest, hence at least the top-5
+        # average, hence above the 15%-below-average hotness threshold.
+        # Eligibility is filtered server-side; retailer status is stamped on
+        # from the cached dict
+        top_heaps = defaultdict(list)
+        offset = 0
+        while True:
+            latest_prices = supabase.table('prices').select(
+                'price_id,smartphone_id,retailer_id,price'
+            ).eq('run_id', latest_run_id).eq(
+                'price_error', False
+            ).in_('retailer_id', allowed_retailers).order(
+                'price_id'
+            ).range(offset, offset + page_size - 1).execute()
+
+            if getattr(latest_prices, 'error', None):
+                logger.error(f"Error getting latest prices: {latest_prices.error}")
+                raise Exception(f"Failed to get latest prices: {latest_prices.error}")
+
+            rows = latest_prices.data
+            if not rows:
+                break
+
+            for price in rows:
+                if price is None:
+                    logger.warning(f"Skipping invalid price record: {price}")
+                    continue
+
+                if price['price'] <= 0:  # Skip invalid prices
+                    logger.warning(f"Skipping non-positive price: {price}")
+                    continue
+
+                heap = top_heaps[price['smartphone_id']]
+                # Flat tuple entries instead of the row dicts: negated price
+                # makes heap[0] the most expensive of the kept five, so
+                # heappushpop evicts it; price_id breaks price ties
+                retailer_id = price['retailer_id']
+                entry = (-price['price'], price['price_id'],
+                         retailer_id, retailer_status[retailer_id])
+                if len(heap) < min_top_prices:
+                    heapq.heappush(heap, entry)
+                else:
+                    heapq.heappushpop(heap, entry)
+
+            if len(rows) < page_size:
+                break
+            offset += page_size
+
+        # Calculate hot prices for each smartphone. hot_prices_info exists
+        # purely for log output, so skip collecting it when INFO is off
+        log_info = logger.isEnabledFor(logging.INFO)
         price_updates = []
         hot_prices_info = []  # For logging
-        
-        for smartphone_id, prices in smartphone_prices.items():
-            if not prices:  # Skip if no valid prices
+
+        for smartphone_id, heap in top_heaps.items():
+            if len(heap) < min_top_prices:
                 continue
-                
-            # Sort prices and get top 5
-            top_5_prices = sorted(prices, key=lambda x: x['price'])[:Config.MIN_TOP_PRICES]
-            
-            if len(top_5_prices) < Config.MIN_TOP_PRICES:
+
+            # Calculate metrics in a single fused pass instead of three
+            # generator walks per smartphone, unpacking the tuple entries
+            # positionally — no dict lookups on the hot path
+            total = 0
+            retailers_seen = set()
+            add_retailer = retailers_seen.add
+            verified_count = 0
+            for neg_price, _, retailer_id, status in heap:
+                total -= neg_price
+                add_retailer(retailer_id)
+                verified_count += status == 'VERIFIED'
+            avg_top_5_price = total / len(heap)
+            unique_retailers = len(retailers_seen)
+
+            # The retailer criteria do not depend on the individual price;
+            # skip the whole smartphone up front if they fail
+            if (unique_retailers < min_unique_retailers or
+                verified_count < min_verified_retailers):
                 continue
-                
-            # Calculate metrics
-            avg_top_5_price = sum(p['price'] for p in top_5_prices) / len(top_5_prices)
-            unique_retailers = len(set(p['retailer_id'] for p in top_5_prices))
-            verified_count = sum(1 for p in top_5_prices if p['relevance_status'] == 'VERIFIED')
-            
-            # Check each price against criteria
-            for price in prices:
-                if price['price'] <= 0:  # Skip invalid prices
-                    logger.warning(f"Skipping non-positive price: {price}")
-                    continue
-                    
-                if (price['price'] < avg_top_5_price * Config.PRICE_THRESHOLD and
-                    unique_retailers >= Config.MIN_UNIQUE_RETAILERS and
-                    verified_count >= Config.MIN_VERIFIED_RETAILERS):
-                    
-                    hotness_score = round((avg_top_5_price - price['price']) / avg_top_5_price * 100, 2)
-                    
+
+            threshold = avg_top_5_price * price_threshold
+            inv_avg = 100.0 / avg_top_5_price
+
+            # Check the retained prices against the threshold (only they can
+            # clear it, see above)
+            for neg_price, price_id, _, _ in heap:
+                price_value = -neg_price
+                if price_value < threshold:
+                    hotness_score = round((avg_top_5_price - price_value) * inv_avg, 2)
+
                     # Add to batch update
                     price_updates.append({
-                        'price_id': price['price_id'],
+                        'price_id': price_id,
                         'is_hot': True,
                         'hotness_score': hotness_score
                     })
-                    
+
                     # Store info for logging
-                    hot_prices_info.append({
-                        'oem': price['oem'],
-                        'model': price['model'],
-                        'price': price['price'],
-                        'hotness_score': hotness_score
-                    })
+                    if log_info:
+                        hot_prices_info.append({
+                            'smartphone_id': smartphone_id,
+                            'price': price_value,
+                            'hotness_score': hotness_score
+                        })
         
         # Perform batch updates
         if price_updates:
             batch_update_prices(price_updates)
         
-        # Log results
-        logger.info(f"Found {len(hot_prices_info)} hot prices in latest run")
-        
-        for price in sorted(hot_prices_info, key=lambda x: x['hotness_score'], reverse=True):
-            logger.info(
-                f"Hot price: {price['oem']} {price['model']} "
-                f"at {price['price']} "
-                f"(hotness score: {price['hotness_score']}%)"
-            )
+        # Log results; oem/model are fetched here for just the hot phones,
+        # and only when the INFO records would actually be emitted
+        if log_info:
+            logger.info(f"Found {len(price_updates)} hot prices in latest run")
+
+            if hot_prices_info:
+                hot_ids = list({p['smartphone_id'] for p in hot_prices_info})
+                phones = supabase.table('smartphones').select(
+                    'smartphone_id,oem,model'
+                ).in_('smartphone_id', hot_ids).execute()
+                phone_names = {p['smartphone_id']: p for p in phones.data}
+
+                # One multiline record instead of a log call per hot price
+                lines = []
+                for price in sorted(hot_prices_info,
+                                    key=itemgetter('hotness_score'), reverse=True):
+                    phone = phone_names.get(price['smartphone_id'], {})
+                    lines.append(
+                        f"  {phone.get('oem')} {phone.get('model')} "
+                        f"at {price['price']} "
+                        f"(hotness score: {price['hotness_score']}%)"
+                    )
+                logger.info("Hot prices:\n" + "\n".join(lines))
                 
     except Exception as e:
         logger.error(f"Error updating hot prices: {str(e)}")